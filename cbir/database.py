@@ -1,5 +1,7 @@
 import os
 import numpy as np
+from scipy import sparse
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 from .dataset import Dataset
 import pickle
@@ -20,10 +22,19 @@ class Database(object):
         # private:
         self._database = {}
         self._image_ids = {}
+        self._matrix = None
+        self._weights = None
+        # encoders with sparse embeddings, like the vocabulary tree, are indexed as sparse rows
+        self._sparse = getattr(encoder, "SPARSE_EMBEDDING", False)
         return
 
     def get_image_id(self, image_path):
-        # normalise the path first
+        # images of the dataset are identified by their position in it
+        image_id = self.dataset.id_of(image_path)
+        if image_id is not None:
+            return image_id
+
+        # other images by their path, normalise it first
         image_path = os.path.abspath(image_path)
 
         # lookup if image has already been hahed
@@ -33,14 +44,39 @@ class Database(object):
 
         return self._image_ids[image_path]
 
-    def index(self):
+    def index(self, parallel=False):
         """
         Generates the inverted index structure using tf-idf.
         This function also calculates the weights for each node as entropy.
+        Args:
+            parallel (bool): if `True`, images are read and encoded by a pool of threads,
+                one per cpu. The embeddings are collected and stored by the calling thread.
         """
         # create inverted index
         print("\nGenerating index...")
-        utils.show_progress(self.embedding, self.dataset.image_paths)
+        image_paths = self.dataset.image_paths
+        n_workers = os.cpu_count() or 1
+        if not parallel or len(image_paths) == 1 or n_workers == 1:
+            utils.show_progress(self.embedding, image_paths)
+        else:
+            total = len(image_paths)
+            chunksize = max(1, total // (4 * n_workers))
+            with ThreadPool(n_workers) as pool:
+                results = pool.imap_unordered(self._embedding_worker, image_paths, chunksize)
+                for image_id, embedding in utils.track_progress(results, total):
+                    self._database[image_id] = embedding
+
+        # the features kept by the encoder to build its vocabulary are not needed anymore
+        if hasattr(self.encoder, "release_features"):
+            self.encoder.release_features()
+
+        # weight and normalise all the embeddings at once, rows are indexed by image id
+        self._weights = self.encoder.weights() if hasattr(self.encoder, "weights") else None
+        embeddings = [self._database[image_id] for image_id in range(len(image_paths))]
+        if self._sparse:
+            self._matrix = self.normalise(sparse.vstack(embeddings, format="csr"))
+        else:
+            self._matrix = self.normalise(np.stack(embeddings))
         return
 
     def is_indexed(self, image_path):
@@ -52,33 +88,113 @@ class Database(object):
         # check if has already been indexed
         if image_id not in self._database:
             # if not, calculate the embedding and index it
-            image = self.dataset.read_image(image_path)
-            self._database[image_id] = self.encoder.embedding(image)
+            self._database[image_id] = self._encode(image_path)
         return self._database[image_id]
 
+    def _encode(self, image_path):
+        """
+        Reads an image and returns its embedding, as a sparse row if the encoder has sparse embeddings
+        """
+        image = self.dataset.read_image(image_path)
+        if self._sparse:
+            return self.encoder.embedding(image, dense=False)
+        return self.encoder.embedding(image)
+
+    def normalise(self, embeddings):
+        """
+        Applies the weights of the encoder, if any, to one or more embeddings
+        and normalises them to unit l2 norm.
+        Sparse embeddings stay sparse, and those with a null norm are left empty
+        """
+        if sparse.issparse(embeddings):
+            embeddings = embeddings.tocsr().astype(np.float64)
+            if self._weights is not None:
+                embeddings = embeddings @ sparse.diags(self._weights)
+            embeddings.eliminate_zeros()
+            norm = np.sqrt(np.asarray(embeddings.multiply(embeddings).sum(axis=1)).ravel())
+            norm[norm == 0] = 1
+            return sparse.csr_matrix(sparse.diags(1 / norm) @ embeddings)
+
+        if self._weights is not None:
+            embeddings = embeddings * self._weights
+        norm = np.linalg.norm(embeddings, ord=2, axis=-1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return embeddings / norm
+
+    def vector(self, image_path):
+        """
+        Returns the weighted and normalised embedding of an image,
+        reading it from the index if the image has been indexed
+        """
+        image_id = self.dataset.id_of(image_path)
+        if self._matrix is not None and image_id is not None:
+            return self._matrix[image_id]
+        return self.normalise(self.embedding(image_path))
+
+    def _embedding_worker(self, image_path):
+        """
+        Computes the embedding of an image without storing it, and returns it with the image id
+        """
+        image_id = self.get_image_id(image_path)
+        if image_id in self._database:
+            return image_id, self._database[image_id]
+        return image_id, self._encode(image_path)
+
     def score(self, db_image_path, query_image_path):
         """
         Measures the similatiries between the set of paths of the features of each image.
         """
         # get the vectors of the images
-        d = self.embedding(db_image_path)
-        q = self.embedding(query_image_path)
-        d = d / np.linalg.norm(d, ord=2)
-        q = q / np.linalg.norm(q, ord=2)
-        # simplified scoring using the l2 norm
-        score = np.linalg.norm(d - q, ord=2)
+        d = self.vector(db_image_path)
+        q = self.vector(query_image_path)
+        if sparse.issparse(q):
+            # empty embeddings have no direction, they match nothing
+            if d.nnz == 0 or q.nnz == 0:
+                return 1e6
+            dot = d.multiply(q).sum()
+        else:
+            dot = d.dot(q)
+        # simplified scoring using the l2 norm: for unit vectors, ||d - q||^2 = 2 - 2d.q
+        score = np.sqrt(np.maximum(2 - 2 * dot, 0))
         return score if not np.isnan(score) else 1e6
 
     def retrieve(self, query_image_path, n=4):
-        # propagate the query down the tree
-        scores = {}
-        for db_image_path in self.dataset.image_paths:
-            scores[db_image_path] = self.score(db_image_path, query_image_path)
+        """
+        Returns the `n` database images closest to the query, as a dictionary
+        Dict[str, float] from image path to score, sorted from the best match.
+        If the query is an image of the dataset, it is not returned as a match of itself
+        """
+        if self._matrix is None:
+            self.index()
 
-        # sorting scores
-        sorted_scores = {k: v for k, v in sorted(
-            scores.items(), key=lambda item: item[1])}
-        return sorted_scores
+        # propagate the query down the tree
+        q = self.vector(query_image_path)
+
+        # score all the database images at once, rows are indexed by image id
+        if sparse.issparse(q):
+            dots = self._matrix.dot(q.T).toarray().ravel()
+            # empty embeddings have no direction, they match nothing
+            dots[self._matrix.getnnz(axis=1) == 0] = np.nan
+            if q.nnz == 0:
+                dots[:] = np.nan
+        else:
+            dots = self._matrix.dot(q)
+        distances = np.sqrt(np.maximum(2 - 2 * dots, 0))
+        distances[np.isnan(distances)] = 1e6
+
+        # leave the query out of the candidates
+        candidates = np.arange(len(distances))
+        query_id = self.dataset.id_of(query_image_path)
+        if query_id is not None:
+            candidates = np.delete(candidates, query_id)
+
+        # select the n best scores, and only sort those
+        n = min(n, len(candidates))
+        if n == 0:
+            return {}
+        top = candidates[np.argpartition(distances[candidates], n - 1)[:n]]
+        top = top[np.argsort(distances[top])]
+        return {self.dataset.image_paths[i]: distances[i] for i in top}
 
     def save(self, path=None):
         if path is None:
@@ -101,15 +217,15 @@ class Database(object):
         return True
 
     def show_results(self, query_path, scores_dict, n=4, figsize=(10, 4)):
-        fig, ax = plt.subplots(1, n + 1, figsize=figsize)
+        results = list(scores_dict.items())[:n]
+
+        fig, ax = plt.subplots(1, len(results) + 1, figsize=figsize, squeeze=False)
+        ax = ax[0]
         ax[0].axis("off")
         ax[0].imshow(self.dataset.read_image(query_path))
         ax[0].set_title("Query image")
-        img_ids = list(scores_dict.keys())
-        scores = list(scores_dict.values())
-        for i in range(1, len(ax)):
+        for i, (path, score) in enumerate(results, 1):
             ax[i].axis("off")
-            ax[i].imshow(self.dataset.read_image(img_ids[i]))
-            ax[i].set_title("#%d. %s Score:%.3f" %
-                            (i, img_ids[i], scores[i]))
+            ax[i].imshow(self.dataset.read_image(path))
+            ax[i].set_title("#%d. %s Score:%.3f" % (i, path, score))
         return
@@ -16,6 +16,7 @@ class Dataset():
         self.path = folder
         self.image_paths = [f for f in sorted(listdir(
             self.path)) if isfile(join(self.path, f))]
+        self._path_to_id = {p: i for i, p in enumerate(self.image_paths)}
         self.subset = Subset(self)
 
     def __str__(self):
@@ -64,6 +65,27 @@ class Dataset():
         image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
         return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+    def id_of(self, image_path):
+        """Returns the id of an image of the dataset, that is its position in `self.image_paths`
+
+        Args:
+            image_path (str): Image name or path. As in `read_image`, the ".jpg" extension
+                can be omitted
+
+        Returns:
+            int: the id of the image, or `None` if the image is not part of the dataset
+        """
+        if not self.is_image(image_path):
+            image_path = image_path + ".jpg"
+        name = os.path.basename(image_path)
+        image_id = self._path_to_id.get(name)
+
+        # a path is only an image of the dataset if it points inside the dataset folder
+        if image_id is not None and name != image_path and \
+                os.path.abspath(join(self.path, name)) != os.path.abspath(image_path):
+            return None
+        return image_id
+
     def get_random_image(self):
         """Returns a random image from the dataset
 
@@ -104,4 +126,5 @@ class Subset(object):
     def __getitem__(self, idx):
         subset = self.dataset
         subset.image_paths = subset.image_paths[idx]
+        subset._path_to_id = {p: i for i, p in enumerate(subset.image_paths)}
         return subset
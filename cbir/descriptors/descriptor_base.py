@@ -1,8 +1,12 @@
 import os
+import threading
 import h5py
 from .. import utils
 import numpy as np
 
+# h5py files cannot be opened by several threads at once, serialise the access to the storage
+_storage_lock = threading.RLock()
+
 
 class DescriptorBase(object):
     def __init__(self, store_root=None):
@@ -12,16 +16,32 @@ class DescriptorBase(object):
             self._storage = None
 
     def __call__(self, image):
-        image_id = utils.get_image_id(image)
+        if self._storage is None:
+            return self.describe(image)
 
-        if not self.is_stored(image_id) and self._storage is not None:
-            features = self.describe(image)
+        image_id = utils.get_image_id(image)
+        features = self._lookup(image_id)
+        if features is None:
+            features = np.array(self.describe(image))
             self.store(image_id, features)
+        return features
 
-        return self.load(image_id)
+    def _lookup(self, image_id):
+        """Loads the stored features of an image opening the storage only once
+
+        Returns: - `None` if the image is not present in the features database
+                 - `numpy.ndarray` of features otherwise
+        """
+        with _storage_lock:
+            if not os.path.isfile(self._storage):
+                return None
+            with h5py.File(self._storage, "r") as file:
+                if image_id not in file:
+                    return None
+                return np.array(file[image_id])
 
     def load(self, image_id):
-        with h5py.File(self._storage, "r") as file:
+        with _storage_lock, h5py.File(self._storage, "r") as file:
                 return np.array(file[image_id])
 
     def store(self, image_id, features, force=False, store_root="data"):
@@ -38,11 +58,12 @@ class DescriptorBase(object):
         if self._storage is None:
             return
 
-        if self.is_stored(image_id) and not force:
-            return
-        with h5py.File(self._storage, "a") as file:
-            features = np.array(features)
-            file.create_dataset(image_id, features.shape, data=features)
+        with _storage_lock:
+            if self.is_stored(image_id) and not force:
+                return
+            with h5py.File(self._storage, "a") as file:
+                features = np.array(features)
+                file.create_dataset(image_id, features.shape, data=features)
         return
 
     def is_stored(self, image_id, store_root="data"):
@@ -57,6 +78,6 @@ class DescriptorBase(object):
         """
         if not os.path.isfile(self._storage):
             return False
-        with h5py.File(self._storage, "r") as file:
+        with _storage_lock, h5py.File(self._storage, "r") as file:
             return image_id in file
         return False
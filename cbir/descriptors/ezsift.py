@@ -1,5 +1,6 @@
 import subprocess
 import os
+import tempfile
 import pandas as pd
 import cv2
 import numpy as np
@@ -26,14 +27,23 @@ class EzSIFT(DescriptorBase):
             os.makedirs('data')
 
         img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        cv2.imwrite('data/do_no_delete_me.pgm', img)
-        cv2.imwrite('data/do_no_delete_me.jpg', img)
 
-        p = subprocess.Popen([self.program, 'data/do_no_delete_me.pgm'], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        p.communicate()
+        # each call works on its own files, so that several threads can describe images at once
+        fd, image_path = tempfile.mkstemp(suffix=".pgm", dir="data")
+        os.close(fd)
+        keypoints_path = image_path + "_sift_key.key"
+        output_path = image_path + "_sift_output.ppm"
+        try:
+            cv2.imwrite(image_path, img)
+            p = subprocess.Popen([self.program, image_path], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            p.communicate()
+            df = self.read_keypoints_file(keypoints_path)
+        finally:
+            for path in (image_path, keypoints_path, output_path):
+                if os.path.exists(path):
+                    os.remove(path)
 
-        df = self.read_keypoints_file()
         if df is None:
             return []
 
@@ -42,8 +52,7 @@ class EzSIFT(DescriptorBase):
         # ToDo - sanity check on number of descriptors
         return descriptors
 
-    def read_keypoints_file(self):
-        path = "data/do_no_delete_me.pgm_sift_key.key"
+    def read_keypoints_file(self, path):
         if os.path.exists(path):
             try:
                 df = pd.read_csv(path, skiprows=(1), sep='\t',
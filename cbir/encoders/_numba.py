@@ -0,0 +1,183 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(nogil=True, fastmath=True, inline="always")
+def closest_child(feature, centroids, centroid_sqnorm, base, n_branches):
+    """
+    Returns the id of the child closest to a feature, among `n_branches` consecutive children from `base`.
+    Children are compared using ||c||^2 - 2x.c, which has the same argmin as the squared
+    l2 distance ||x - c||^2, since ||x||^2 is constant across the children of a node.
+    """
+    closest = base
+    min_dist = np.inf
+    for child in range(base, base + n_branches):
+        dot = 0.
+        for k in range(feature.shape[0]):
+            dot += feature[k] * centroids[child, k]
+        distance = centroid_sqnorm[child] - 2. * dot
+        if distance < min_dist:
+            min_dist = distance
+            closest = child
+    return closest
+
+
+@njit(nogil=True, inline="always")
+def l2sq_u8(x, c):
+    """
+    Squared l2 distance between two uint8 vectors, accumulated exactly in int32
+    """
+    distance = np.int32(0)
+    for k in range(x.shape[0]):
+        diff = np.int32(x[k]) - np.int32(c[k])
+        distance += diff * diff
+    return distance
+
+
+@njit(nogil=True, inline="always")
+def closest_child_u8(feature, centroids, base, n_branches):
+    """
+    Same as `closest_child`, for a feature and centroids quantised to uint8.
+    Distances are exact integers, so no norms are needed.
+    """
+    closest = base
+    min_dist = l2sq_u8(feature, centroids[base])
+    for child in range(base + 1, base + n_branches):
+        distance = l2sq_u8(feature, centroids[child])
+        if distance < min_dist:
+            min_dist = distance
+            closest = child
+    return closest
+
+
+@njit(parallel=True, fastmath=True, nogil=True, cache=True)
+def descend_njit(features, centroids, centroid_sqnorm, first_child, is_leaf, n_branches, leaves):
+    """
+    Propagates a batch of features down a vocabulary tree stored as flat arrays,
+    writing the leaf reached by each feature into `leaves`.
+    The path of a feature is fully determined by its leaf, see `count_visits_njit`.
+    Args:
+        features (numpy.ndarray): (n_features, dim) float32 array of features
+        centroids (numpy.ndarray): (n_nodes, dim) float32 array with the value of each node
+        centroid_sqnorm (numpy.ndarray): (n_nodes,) float32 array with the squared l2 norm of each node
+        first_child (numpy.ndarray): id of the first child of each node. Siblings have consecutive ids
+        is_leaf (numpy.ndarray): boolean mask of the leaf nodes
+        n_branches (int): number of children of each internal node
+        leaves (numpy.ndarray): (n_features,) int64 array. It must contain the node to start from,
+                                and it is overwritten with the leaves
+    """
+    for i in prange(features.shape[0]):
+        node = leaves[i]
+        while not is_leaf[node]:
+            node = closest_child(features[i], centroids, centroid_sqnorm, first_child[node], n_branches)
+        leaves[i] = node
+    return leaves
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def descend_u8_njit(features, centroids, first_child, is_leaf, n_branches, leaves):
+    """
+    Same as `descend_njit`, for features and centroids quantised to uint8.
+    Args:
+        features (numpy.ndarray): (n_features, dim) uint8 array of features
+        centroids (numpy.ndarray): (n_nodes, dim) uint8 array with the value of each node
+        first_child (numpy.ndarray): id of the first child of each node. Siblings have consecutive ids
+        is_leaf (numpy.ndarray): boolean mask of the leaf nodes
+        n_branches (int): number of children of each internal node
+        leaves (numpy.ndarray): (n_features,) int64 array. It must contain the node to start from,
+                                and it is overwritten with the leaves
+    """
+    for i in prange(features.shape[0]):
+        node = leaves[i]
+        while not is_leaf[node]:
+            node = closest_child_u8(features[i], centroids, first_child[node], n_branches)
+        leaves[i] = node
+    return leaves
+
+
+@njit(nogil=True, cache=True)
+def count_visits_njit(leaves, parent, visits):
+    """
+    Counts the visits of each node, walking up from the leaf of each feature to the root.
+    Args:
+        leaves (numpy.ndarray): (n_features,) int64 array with the leaf reached by each feature
+        parent (numpy.ndarray): id of the parent of each node, -1 for the root
+        visits (numpy.ndarray): (n_nodes,) int64 array, incremented in place
+    """
+    for i in range(leaves.shape[0]):
+        node = leaves[i]
+        while node >= 0:
+            visits[node] += 1
+            node = parent[node]
+    return visits
+
+
+@njit(parallel=True, fastmath=True, nogil=True, cache=True)
+def assign_njit(features, centroids, centroid_sqnorm, labels):
+    """
+    Assigns each feature to its closest centroid, updating `labels` in place.
+    Distances are computed as ||c||^2 - 2x.c, with all the products obtained from a single matrix product.
+    Args:
+        features (numpy.ndarray): (n_features, dim) float32 array of features
+        centroids (numpy.ndarray): (k, dim) float32 array of centroids
+        centroid_sqnorm (numpy.ndarray): (k,) float32 array with the squared l2 norm of each centroid
+        labels (numpy.ndarray): (n_features,) int64 array with the current assignments
+    Returns:
+        (int): the number of features whose assignment has changed
+    """
+    k = centroids.shape[0]
+    products = np.dot(features, centroids.T)
+    n_changed = 0
+    for i in prange(features.shape[0]):
+        closest = 0
+        min_dist = np.inf
+        for j in range(k):
+            distance = centroid_sqnorm[j] - 2. * products[i, j]
+            if distance < min_dist:
+                min_dist = distance
+                closest = j
+        if labels[i] != closest:
+            labels[i] = closest
+            n_changed += 1
+    return n_changed
+
+
+@njit(nogil=True, cache=True)
+def kmeans_njit(features, init, n_iter=20):
+    """
+    Lloyd's k-means, specialised for float32 features and a small number of clusters.
+    Centroids are initialised with the features at the indices `init`, one per cluster.
+    Empty clusters keep their previous centroid.
+    Args:
+        features (numpy.ndarray): (n_features, dim) float32 array of features
+        init (numpy.ndarray): (k,) int64 array with the indices of k distinct features.
+            They are drawn by the caller, so that numpy's global random state makes the clustering reproducible
+        n_iter (int): maximum number of iterations
+    Returns:
+        (Tuple[numpy.ndarray, numpy.ndarray]): the (k, dim) centroids and the label of each feature
+    """
+    n_features, dim = features.shape
+    k = init.shape[0]
+    centroids = features[init].copy()
+    labels = np.full(n_features, -1, dtype=np.int64)
+    sums = np.empty((k, dim), dtype=np.float32)
+    counts = np.empty(k, dtype=np.int64)
+    sqnorm = (centroids * centroids).sum(axis=1)
+    for _ in range(n_iter):
+        if assign_njit(features, centroids, sqnorm, labels) == 0:
+            return centroids, labels
+
+        # move each centroid to the mean of its features
+        sums[:] = 0
+        counts[:] = 0
+        for i in range(n_features):
+            counts[labels[i]] += 1
+            for d in range(dim):
+                sums[labels[i], d] += features[i, d]
+        for j in range(k):
+            if counts[j] > 0:
+                for d in range(dim):
+                    centroids[j, d] = sums[j, d] / counts[j]
+        sqnorm = (centroids * centroids).sum(axis=1)
+    assign_njit(features, centroids, sqnorm, labels)
+    return centroids, labels
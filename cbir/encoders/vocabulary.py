@@ -1,25 +1,85 @@
 import os
 import pickle
+import threading
+from collections import deque
 import numpy as np
 import matplotlib.pyplot as plt
 import networkx as nx
-from sklearn.cluster import MiniBatchKMeans
+from scipy import sparse
+from scipy.spatial import cKDTree
 from .. import utils
+from ._numba import descend_njit, descend_u8_njit, count_visits_njit, kmeans_njit
+
+# numba's default threading layer cannot run parallel kernels from several threads at once
+_kernel_lock = threading.Lock()
 
 
 class VocabularyTree(object):
-    def __init__(self, n_branches, depth, descriptor):
+    BACKENDS = ("tree", "kdtree", "faiss")
+    # embeddings are rows of term frequencies, see `embedding`
+    SPARSE_EMBEDDING = True
+
+    def __init__(self, n_branches, depth, descriptor, backend="tree", quantize=False):
+        """
+        Args:
+            n_branches (int): number of children of each internal node
+            depth (int): maximum depth of the tree
+            descriptor (callable): extracts the features of an image
+            backend (str): how features are assigned to the nodes of the tree.
+                - "tree": greedy descent from the root, comparing the children of each visited node
+                - "kdtree": exact nearest leaf, using a scipy.spatial.cKDTree over the leaves
+                - "faiss": exact nearest leaf, using a faiss.IndexFlatL2 over the leaves.
+                  Requires faiss to be installed
+                With the exact backends, the path of a feature is made of its nearest leaf and its ancestors
+            quantize (bool): if `True`, the "tree" backend compares features and centroids as uint8,
+                rounding and clipping them to [0, 255]. Only meaningful for descriptors whose values
+                are bytes, like ORB or SIFT
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("Invalid backend %s, must be one of %s" % (backend, self.BACKENDS))
         self.n_branches = n_branches
         self.depth = depth
         self.descriptor = descriptor
+        self.backend = backend
+        self.quantize = quantize
 
-        self.tree = {}
-        self.nodes = {}
-        self.graph = nx.DiGraph()
+        # flat representation of the tree, indexed by node id
+        self.parent = np.empty(0, dtype=np.int64)
+        self.first_child = np.empty(0, dtype=np.int64)
+        self.is_leaf = np.empty(0, dtype=bool)
+        self.centroid_table = np.empty((0, 0), dtype=np.float32)
+        self.centroid_sqnorm = np.empty(0, dtype=np.float32)
+        self.centroid_table_u8 = np.empty((0, 0), dtype=np.uint8)
+        self.node_depth = np.empty(0, dtype=np.int64)
 
         # private:
-        self._current_index = 0
-        self._propagated = set()
+        self._graph = None
+        self._pos = {}
+        self._leaf_ids = None
+        self._leaf_index = None
+        self._tf_rows = {}
+        self._features = None
+        self._offsets = {}
+
+    @property
+    def nodes(self):
+        """
+        The value of each node as a dictionary Dict[int, numpy.ndarray], built from `self.centroid_table`
+        """
+        return {node: value for node, value in enumerate(self.centroid_table)}
+
+    @property
+    def graph(self):
+        """
+        A networkx representation of the tree, built lazily from the flat arrays.
+        It is only used for drawing.
+        """
+        if self._graph is None:
+            self._graph = nx.DiGraph()
+            self._graph.add_nodes_from(range(len(self.parent)))
+            self._graph.add_edges_from(
+                (int(p), child) for child, p in enumerate(self.parent) if p >= 0)
+        return self._graph
 
     def learn(self, dataset):
         features = self.extract_features(dataset)
@@ -27,80 +87,255 @@ class VocabularyTree(object):
         return self
 
     def extract_features(self, dataset):
+        """
+        Extracts the features of all the images in a dataset.
+        The features are kept, together with the range of rows of each image,
+        so that `propagate` can reuse them instead of describing the image again.
+        They are released once every image has been propagated, or by `release_features`.
+        Args:
+            dataset (Dataset): the images to describe
+        Returns:
+            (numpy.ndarray): the features of all the images, stacked along dim 0
+        """
         print("Extracting features...")
-        func = lambda path: self.descriptor(dataset.read_image(path))
-        features = utils.show_progress(func, dataset)
-        print("\n%d features extracted" % len(features))
-        return np.array(features)
+        image_ids = []
+
+        def describe(path):
+            image = dataset.read_image(path)
+            image_ids.append(utils.get_image_id(image))
+            return self.descriptor(image)
+
+        chunks = utils.show_progress(describe, dataset)
+
+        dim = next((np.shape(chunk)[1] for chunk in chunks if len(chunk)), None)
+        if dim is None:
+            raise ValueError("No features were extracted from the %d images of the dataset" % len(chunks))
+
+        # copy the features of each image into a single preallocated buffer, casting them on assignment.
+        # Images without descriptors give an empty list, reshaped to an empty (0, dim) block
+        counts = [len(chunk) for chunk in chunks]
+        self._features = np.empty((sum(counts), dim), dtype=np.float32)
+        self._offsets = {}
+        start = 0
+        for image_id, count, chunk in zip(image_ids, counts, chunks):
+            self._features[start:start + count] = np.reshape(chunk, (-1, dim))
+            self._offsets[image_id] = (start, start + count)
+            start += count
+        print("\n%d features extracted" % len(self._features))
+        return self._features
 
-    def fit(self, features, node=0, root=None, current_depth=0):
+    def fit(self, features):
         """
         Generates a hierarchical vocabulary tree representation of some input features
         using hierarchical k-means clustering.
-        This function populates the graph and stores the value of the features in
-        `self.nodes` as a dictionary Dict[int, numpy.ndarray] that stores the actual value for each node
+        The value of each node is stored in `self.centroid_table`, a contiguous
+        (n_nodes, dim) float32 matrix indexed by node id.
+        The children of a node have consecutive ids, so the centroids of the children of a node
+        are contiguous rows of the table, and the tree is compiled into the flat arrays
+        `self.parent`, `self.first_child` and `self.is_leaf`, indexed by node id.
         Args:
             features (numpy.ndarray): a two dimensional vector of input features where dim 0 is samples and dim 1 is features
-            node (int): current node id to set
-            root (numpy.ndarray): the value of the parent of the `node` as a virtual feature
-            current_depth (int): the depth of the node as the distance in jumps from the very root of the tree
         """
-        if root is None:
-            root = np.mean(features, axis=0)
+        self._graph = None
+        self._pos = {}
+        self._leaf_ids = None
+        self._leaf_index = None
+        self._tf_rows = {}
 
-        self.nodes[node] = root
-        self.graph.add_node(node)
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if self.n_branches > 1:
+            max_nodes = (self.n_branches ** (self.depth + 1) - 1) // (self.n_branches - 1)
+        else:
+            max_nodes = self.depth + 1
+        self.parent = np.full(max_nodes, -1, dtype=np.int64)
+        self.first_child = np.full(max_nodes, -1, dtype=np.int64)
+        self.is_leaf = np.ones(max_nodes, dtype=bool)
+        self.node_depth = np.zeros(max_nodes, dtype=np.int64)
+        self.centroid_table = np.empty((max_nodes, features.shape[1]), dtype=np.float32)
+        self.centroid_table[0] = features.mean(axis=0, dtype=np.float32)
 
-        # if `node` is a leaf node, return
-        if current_depth >= self.depth or len(features) < self.n_branches:
-            return
+        # breadth first clustering, each work item is a node and the features that belong to it
+        n_nodes = 1
+        queue = deque([(0, features)])
+        while queue:
+            node, node_features = queue.popleft()
+            current_depth = self.node_depth[node]
+
+            # if `node` is a leaf node, move on
+            if current_depth >= self.depth or len(node_features) < self.n_branches:
+                continue
+
+            # group features by cluster
+            print("Computing clusters %d/%d with %d features from node %d at level %d\t\t" %
+                  (n_nodes, max_nodes, len(node_features), node, current_depth),
+                  end="\r")
+            init = np.random.choice(len(node_features), self.n_branches, replace=False)
+            cluster_centers, labels = kmeans_njit(node_features, init)
+
+            # bucket the features by cluster: sort them by label and split them into contiguous views
+            order = np.argsort(labels, kind="stable")
+            bounds = np.cumsum(np.bincount(labels, minlength=self.n_branches))
+            children = np.split(node_features[order], bounds[:-1])
 
-        # group features by cluster
-        print("Computing clusters %d/%d with %d features from node %d at level %d\t\t" %
-              (self._current_index, self.n_branches ** self.depth, len(features), node, current_depth),
-              end="\r")
-        model = MiniBatchKMeans(n_clusters=self.n_branches)
-        model.fit(features)
-        children = [[] for i in range(self.n_branches)]
-        for i in range(len(features)):
-            children[model.labels_[i]].append(features[i])
-
-        # cluster children
-        self.tree[node] = []
-        for i in range(self.n_branches):
-            self._current_index += 1
-            self.tree[node].append(self._current_index)
-            self.graph.add_edge(node, self._current_index)
-            self.fit(children[i], self._current_index,
-                     model.cluster_centers_[i], current_depth + 1)
+            # allocate consecutive ids for the children, then enqueue them
+            first_child = n_nodes
+            n_nodes += self.n_branches
+            self.first_child[node] = first_child
+            self.is_leaf[node] = False
+            self.parent[first_child:n_nodes] = node
+            self.node_depth[first_child:n_nodes] = current_depth + 1
+            self.centroid_table[first_child:n_nodes] = cluster_centers
+            for i in range(self.n_branches):
+                queue.append((first_child + i, children[i]))
+
+        self._compile(n_nodes)
         return
 
+    def _compile(self, n_nodes):
+        """
+        Trims the arrays preallocated by `fit` to the nodes actually created,
+        and precomputes the quantities used to propagate features
+        Args:
+            n_nodes (int): the number of nodes of the tree
+        """
+        self.parent = self.parent[:n_nodes]
+        self.first_child = self.first_child[:n_nodes]
+        self.is_leaf = self.is_leaf[:n_nodes]
+        self.node_depth = self.node_depth[:n_nodes]
+        self.centroid_table = self.centroid_table[:n_nodes]
+        self.centroid_sqnorm = np.einsum("ij,ij->i", self.centroid_table, self.centroid_table)
+        if self.quantize:
+            self.centroid_table_u8 = self._to_u8(self.centroid_table)
+        return
+
+    @staticmethod
+    def _to_u8(values):
+        """
+        Quantises an array to uint8, rounding and clipping its values to [0, 255]
+        """
+        return np.ascontiguousarray(np.clip(np.rint(values), 0, 255), dtype=np.uint8)
+
+    def _search_leaves(self, features):
+        """
+        Finds the nearest leaf of each feature, building the index of the leaves if needed
+        Args:
+            features (numpy.ndarray): (n_features, dim) float32 array of features
+        Returns:
+            (numpy.ndarray): the node id of the nearest leaf of each feature
+        """
+        if self._leaf_index is None:
+            self._leaf_ids = np.flatnonzero(self.is_leaf)
+            leaves = np.ascontiguousarray(self.centroid_table[self._leaf_ids])
+            if self.backend == "faiss":
+                import faiss
+                self._leaf_index = faiss.IndexFlatL2(leaves.shape[1])
+                self._leaf_index.add(leaves)
+            else:
+                self._leaf_index = cKDTree(leaves)
+
+        if self.backend == "faiss":
+            _, nearest = self._leaf_index.search(features, 1)
+            nearest = nearest[:, 0]
+        else:
+            _, nearest = self._leaf_index.query(features)
+        return self._leaf_ids[nearest]
+
     def propagate(self, image):
         """
         Proapgates the features of an image down the tree, until the find a leaf.
-        Every time they pass through a node, they leave a fingerprint, by storing a key value pairm
-        where the key is the id of the image and the value is the number of times that node is visited.
+        Every time they pass through a node, they leave a fingerprint: the number of times each node
+        is visited is stored as a sparse row of term frequencies for the image, see `embedding`.
         This results into an tf-idf scheme.
         Args:
             image_path (str): path of the image to encode
         """
         image_id = utils.get_image_id(image)
-        if (image_id in self._propagated):
+        if (image_id in self._tf_rows):
             return
 
-        features = self.descriptor(image)
-        for feature in features:
-            path = self.propagate_feature(feature)
-            for i in range(len(path)):
-                node = path[i]
-                # add tfidf
-                if image_id not in self.graph.nodes[node]:
-                    self.graph.nodes[node][image_id] = 1
-                else:
-                    self.graph.nodes[node][image_id] += 1
-        self._propagated.add(image_id)
+        # keep references to the extracted features, another thread may release them meanwhile
+        extracted, offsets = self._features, self._offsets
+        rows = offsets.pop(image_id, None)
+        if rows is not None:
+            features = extracted[rows[0]:rows[1]]
+            if not offsets:
+                self.release_features()
+        else:
+            features = self.descriptor(image)
+        leaves = self.propagate_leaves(features)
+
+        # count the visits of each node walking up from the leaves,
+        # and store them as l1 normalised term frequencies
+        visits = count_visits_njit(leaves, self.parent, np.zeros(len(self.parent), dtype=np.int64))
+        self._tf_rows[image_id] = sparse.csr_matrix(visits[np.newaxis] / max(visits.sum(), 1))
+        return
+
+    def release_features(self):
+        """
+        Frees the features kept by `extract_features`. Images that have not been propagated yet
+        will be described again
+        """
+        self._features = None
+        self._offsets = {}
         return
 
+    def propagate_leaves(self, features, node=0):
+        """
+        Propagates a batch of features down the tree, and returns the leaf reached by each of them.
+        With the "tree" backend, the descent is compiled with numba and runs in parallel over the features.
+        With the other backends, each feature is assigned to its nearest leaf.
+        Args:
+            features (numpy.ndarray): a two dimensional array of features to lookup
+            node (int): Node id to start the search from.
+                        Default is 0, meaning the very root of the tree. Only the "tree" backend
+                        can start from another node
+        Returns:
+            (numpy.ndarray): the node id of the leaf reached by each feature
+        """
+        # images without descriptors give an empty list, make it an empty batch of features
+        features = np.ascontiguousarray(features, dtype=np.float32).reshape(
+            -1, self.centroid_table.shape[1])
+        if self.backend != "tree":
+            if node != 0:
+                raise ValueError("The %s backend can only propagate from the root" % self.backend)
+            return self._search_leaves(features)
+
+        leaves = np.full(len(features), node, dtype=np.int64)
+        with _kernel_lock:
+            if self.quantize:
+                # `quantize` may have been set after fitting the tree
+                if len(self.centroid_table_u8) != len(self.parent):
+                    self.centroid_table_u8 = self._to_u8(self.centroid_table)
+                return descend_u8_njit(self._to_u8(features), self.centroid_table_u8,
+                                       self.first_child, self.is_leaf, self.n_branches, leaves)
+            return descend_njit(features, self.centroid_table, self.centroid_sqnorm,
+                                self.first_child, self.is_leaf, self.n_branches, leaves)
+
+    def propagate_features(self, features, node=0):
+        """
+        Propagates a batch of features down the tree, and returns their paths in the form of node ids.
+        The paths are made of the leaves returned by `propagate_leaves` and their ancestors.
+        Args:
+            features (numpy.ndarray): a two dimensional array of features to lookup
+            node (int): Node id to start the search from.
+                        Default is 0, meaning the very root of the tree
+        Returns:
+            (numpy.ndarray): an (n_features, depth + 1) array of node ids. Paths that end in a leaf
+                             before reaching the maximum depth are padded with -1
+        """
+        nodes = self.propagate_leaves(features, node)
+        paths = np.full((len(nodes), self.depth + 1), -1, dtype=np.int64)
+
+        # walk up from the leaves to `node`, filling the paths from the bottom
+        rows = np.arange(len(nodes))
+        levels = self.node_depth[nodes] - self.node_depth[node]
+        while (levels >= 0).any():
+            valid = levels >= 0
+            paths[rows[valid], levels[valid]] = nodes[valid]
+            nodes = np.where(valid, self.parent[nodes], -1)
+            levels -= 1
+        return paths
+
     def propagate_feature(self, feature, node=0):
         """
         Propagates a feature, down the tree, and returns the paths in the form of node ids.
@@ -109,39 +344,49 @@ class VocabularyTree(object):
             root (List[int]): Node id to start the search from.
                         Default is 0, meaning the very root of the tree
         """
-        path = [node]
-        while self.graph.out_degree(node):  # recur, stop if leaf
-            min_dist = float("inf")
-            closest = None
-            for child in self.graph[node]:
-                distance = np.linalg.norm(
-                    [self.nodes[child] - feature])  # l1 norm
-                if distance < min_dist:
-                    min_dist = distance
-                    closest = child
-            path.append(closest)
-            node = closest
-        return path
-
-    def embedding(self, image):
-        self.propagate(image)
-
-        image_id = utils.get_image_id(image)
+        path = self.propagate_features(np.atleast_1d(feature)[np.newaxis], node)[0]
+        return path[path >= 0].tolist()
 
-        # weights = np.array(self.graph.nodes(data="w", default=1))[:, 1]
-        embedding = np.array(self.graph.nodes(data=image_id, default=0))[:, 1]
+    def _document_frequency(self):
+        """
+        Returns the number of propagated images that pass through each node
+        """
+        rows = list(self._tf_rows.values())
+        if not rows:
+            return np.zeros(len(self.parent), dtype=np.int64)
+        return np.bincount(np.concatenate([row.indices for row in rows]), minlength=len(self.parent))
 
-        # normalise the embeddings
-        embedding = embedding / np.linalg.norm(embedding, ord=2)  # l2 norm
+    def weights(self):
+        """
+        Returns the inverse document frequency of each node, ln(N / N_i), where N is the
+        number of propagated images and N_i the number of them that pass through the node i.
+        Nodes that are never visited have weight 0.
+        """
+        n_i = self._document_frequency()
+        idf = np.zeros(len(n_i))
+        idf[n_i > 0] = np.log(len(self._tf_rows) / n_i[n_i > 0])
+        return idf
 
-        return embedding  # * weights
+    def embedding(self, image, dense=True):
+        """
+        Returns the l1 normalised term frequencies of an image,
+        propagating the image down the tree if needed
+        Args:
+            image (numpy.ndarray): the image to encode
+            dense (bool): if `True`, the embedding is a dense vector,
+                otherwise it is the (1, n_nodes) sparse row stored by `propagate`
+        """
+        self.propagate(image)
+        image_id = utils.get_image_id(image)
+        if not dense:
+            return self._tf_rows[image_id]
+        return self._tf_rows[image_id].toarray().ravel()
 
     def subgraph(self, image_id):
-        subgraph = self.graph.subgraph(
-            [k for k, v in self.graph.nodes(data=image_id, default=None) if v is not None])
-        colours = ["C0"] * len(self.graph.nodes)
-        for node in subgraph.nodes:
-            colours[node] = "C3"
+        visited = self._tf_rows[image_id].indices if image_id in self._tf_rows else []
+        subgraph = self.graph.subgraph(visited)
+        colours = np.full(len(self.parent), "C0", dtype=object)
+        colours[visited] = "C3"
         self.draw(node_color=colours)
         return subgraph
 
@@ -149,24 +394,34 @@ class VocabularyTree(object):
         if path is None:
             path = "data"
 
-        # store graph
-        nx.write_gpickle(self.graph, os.path.join(path, "graph.pickle"))
+        # store the structure of the tree and the value of its nodes
+        np.savez(os.path.join(path, "tree.npz"), parent=self.parent,
+                 first_child=self.first_child, is_leaf=self.is_leaf,
+                 centroid_table=self.centroid_table)
 
-        # store nodes with features
-        with open(os.path.join(path, "nodes.pickle"), "wb") as f:
-            pickle.dump(self.nodes, f)
+        # store the term frequencies of the propagated images
+        with open(os.path.join(path, "tf.pickle"), "wb") as f:
+            pickle.dump(self._tf_rows, f)
 
         return True
 
+    def _layout(self, prog):
+        """
+        Returns the graphviz layout of the tree for the given program.
+        Layouts are computed once, and cached until the tree is fitted again
+        """
+        if prog not in self._pos:
+            self._pos[prog] = nx.drawing.nx_agraph.graphviz_layout(self.graph, prog=prog)
+        return self._pos[prog]
+
     def draw(self, figsize=None, node_color=None, layout="tree", labels=None):
         figsize = (30, 10) if figsize is None else figsize
         fig = plt.figure(figsize=figsize)
         layout = layout.lower()
         if "tree" in layout:
-            pos = nx.drawing.nx_agraph.graphviz_layout(self.graph, prog="dot")
+            pos = self._layout("dot")
         elif "radial" in layout:
-            pos = nx.drawing.nx_agraph.graphviz_layout(
-                self.graph, prog="twopi")
+            pos = self._layout("twopi")
         else:
             pos = None
         if labels is None:
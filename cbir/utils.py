@@ -1,7 +1,6 @@
 import time
 import datetime
 import hashlib
-import numpy as np
 import torch
 
 
@@ -12,19 +11,34 @@ def show_progress(func, iterable, **kwargs):
     iterable (iterable): an iterable to loop through
 
     Use **kwargs to provide additional inputs to the function
+    Returns the list of the results of `func`, one per item
     """
-    results = []
-    times = []
-    total = len(iterable)
-    for i, item in enumerate(iterable):
-        start = time.time()
-        results.extend(func(item, **kwargs))
-        times.append(time.time() - start)
-        avg = np.mean(times)
+    results = (func(item, **kwargs) for item in iterable)
+    return list(track_progress(results, len(iterable)))
+
+
+def track_progress(results, total):
+    """
+    Yields the items of an iterator of results, printing an expected time of arrival
+    results (iterator): the results, computed as they are requested
+    total (int): the number of results
+
+    The ETA is computed from the running sum of the time spent waiting for each result
+    """
+    elapsed = 0.
+    results = iter(results)
+    for i in range(total):
+        start = time.perf_counter()
+        try:
+            result = next(results)
+        except StopIteration:
+            return
+        elapsed += time.perf_counter() - start
+        avg = elapsed / (i + 1)
         eta = avg * total - avg * (i + 1)
         eta = datetime.timedelta(seconds=eta)
         print("Progress %d/%d - ETA: %s" % (i + 1, total, eta), end="\r")
-    return results
+        yield result
 
 
 def get_image_id(array):